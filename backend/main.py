@@ -4,25 +4,165 @@ Ollama OpenAI 兼容 API 代理服务
 将 Ollama API 转换为 OpenAI 兼容格式
 """
 
-from fastapi import FastAPI, HTTPException
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse
+import aiohttp
+import asyncio
 import httpx
-import json
 import logging
+import orjson
+import os
+import secrets
+import sys
 import time
-import uuid
-from typing import List, Dict, Optional
+from typing import AsyncGenerator, AsyncIterator, List, Dict, Optional, Tuple, Union
 from pydantic import BaseModel
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Ollama配置
+OLLAMA_BASE_URL = "http://localhost:11434"
+TIMEOUT = 60.0
+
+# 同时发往 Ollama 的生成请求上限，建议与 Ollama 的 OLLAMA_NUM_PARALLEL 保持一致
+OLLAMA_MAX_INFLIGHT = int(os.getenv("OLLAMA_MAX_INFLIGHT", "8"))
+# 排队等待并发槽位的最长时间（秒），超时直接返回 503，避免请求无限堆积
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "30"))
+OLLAMA_SEM = asyncio.Semaphore(OLLAMA_MAX_INFLIGHT)
+
+# 响应缓存：只缓存 temperature 为 0 的确定性请求，按 LRU 淘汰
+CACHE_MAX = 1024
+response_cache: "OrderedDict[Tuple, Tuple[str, Dict]]" = OrderedDict()
+
+# 正在进行中的确定性请求，相同请求并发到达时共享同一次 Ollama 生成
+inflight: Dict[Tuple, asyncio.Task] = {}
+inflight_streams: Dict[Tuple, "StreamFanout"] = {}
+
+# 流式输出合并：累积超过 STREAM_FLUSH_BYTES 字节或距上次发送超过 STREAM_FLUSH_INTERVAL 秒时才发送一个 SSE 事件
+STREAM_FLUSH_BYTES = 64
+STREAM_FLUSH_INTERVAL = 0.01
+# SSE 流结束标记，预先编码为字节避免每个流重复编码
+DONE_BYTES = b"data: [DONE]\n\n"
+
+# 模型列表缓存（秒），Ollama 已安装的模型很少变化，避免每次轮询都请求 /api/tags
+MODELS_CACHE_TTL = 30.0
+_models_cache: Dict = {"ts": 0.0, "data": None}
+
+# 健康检查：正常响应预先序列化，并在短时间内复用上次成功的探测结果，减少对 Ollama 的探测请求
+HEALTH_CACHE_TTL = 2.0
+HEALTHY_BYTES = orjson.dumps({
+    "status": "healthy",
+    "ollama": "connected",
+    "api": "openai-compatible"
+})
+_health_cache: Dict = {"ts": float("-inf")}
+
+# 性能诊断：METRICS=1 时记录各阶段耗时，并在安装了 prometheus-fastapi-instrumentator 时暴露 /metrics
+METRICS_ENABLED = os.getenv("METRICS") == "1"
+ollama_latency = None
+ollama_pieces = None
+
+# 共享的 HTTP 客户端，在应用启动时创建，复用连接池避免每个请求重新建立连接
+# httpx 用于模型列表、健康检查等轻量请求；生成请求走 aiohttp，高并发下吞吐更好
+client: Optional[httpx.AsyncClient] = None
+session: Optional[aiohttp.ClientSession] = None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """应用生命周期：启动时创建共享客户端，关闭时释放连接"""
+    global client, session
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=256,
+            limit_per_host=256,
+            keepalive_timeout=60
+        ),
+        # 与 httpx 的超时语义保持一致：限制连接和单次读取，不限制流式响应总时长
+        timeout=aiohttp.ClientTimeout(total=None, connect=TIMEOUT, sock_read=TIMEOUT)
+    )
+    client = httpx.AsyncClient(
+        base_url=OLLAMA_BASE_URL,
+        http2=True,
+        timeout=TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=256,
+            max_keepalive_connections=128,
+            keepalive_expiry=60
+        )
+    )
+    try:
+        yield
+    finally:
+        await session.close()
+        await client.aclose()
+        session = None
+        client = None
+
+
+class OllamaSlot:
+    """已占用的 Ollama 并发槽位，release() 可以重复调用"""
+
+    def __init__(self):
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            OLLAMA_SEM.release()
+
+
+async def acquire_ollama_slot() -> OllamaSlot:
+    """占用一个 Ollama 并发槽位，排队超时则返回 503"""
+    started = time.perf_counter_ns() if METRICS_ENABLED else 0
+    try:
+        await asyncio.wait_for(OLLAMA_SEM.acquire(), OLLAMA_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Ollama is busy, please retry later")
+    if METRICS_ENABLED:
+        record_timing("slot_wait", time.perf_counter_ns() - started)
+    return OllamaSlot()
+
+
+@asynccontextmanager
+async def ollama_slot():
+    """在 with 块内占用一个 Ollama 并发槽位"""
+    slot = await acquire_ollama_slot()
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+class OllamaStreamingResponse(StreamingResponse):
+    """
+    持有 Ollama 槽位的流式响应
+    槽位通常由生成器在结束时释放；客户端在响应体开始前断开等情况下生成器不会运行，响应结束时兜底释放
+    """
+
+    def __init__(self, content, slot: Optional[OllamaSlot] = None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.slot is not None:
+                self.slot.release()
+
+
 app = FastAPI(
     title="Ollama OpenAI Compatible API",
     description="OpenAI-compatible proxy for Ollama",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=lifespan
 )
 
 # CORS配置
@@ -34,9 +174,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Ollama配置
-OLLAMA_BASE_URL = "http://localhost:11434"
-TIMEOUT = 60.0
+# 压缩较大的 JSON 响应（如模型列表、长文本的非流式结果）；text/event-stream 流式响应不会被压缩
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+if METRICS_ENABLED:
+    @app.middleware("http")
+    async def log_request_timing(request: Request, call_next):
+        """记录请求耗时；流式响应只统计到响应头发出为止"""
+        started = time.perf_counter_ns()
+        response = await call_next(request)
+        elapsed_ms = (time.perf_counter_ns() - started) / 1e6
+        logger.info(f"{request.method} {request.url.path} {response.status_code} - {elapsed_ms:.1f}ms")
+        return response
+
+    try:
+        from prometheus_client import CollectorRegistry, Counter, Histogram
+        from prometheus_fastapi_instrumentator import Instrumentator
+    except ImportError:
+        logger.warning("prometheus-fastapi-instrumentator is not installed, /metrics is disabled")
+    else:
+        # uvicorn.run("main:app") 会让本模块再以 main 的名字执行一次，
+        # 使用私有 registry 避免在全局 REGISTRY 中重复注册同名指标
+        metrics_registry = CollectorRegistry()
+        Instrumentator(registry=metrics_registry).instrument(app).expose(app)
+        ollama_latency = Histogram(
+            "ollama_stage_seconds", "Time spent in each Ollama proxy stage", ["stage"],
+            registry=metrics_registry)
+        ollama_pieces = Counter(
+            "ollama_stream_pieces_total", "Response pieces streamed from Ollama",
+            registry=metrics_registry)
 
 # Pydantic 模型定义
 
@@ -67,30 +233,40 @@ class CompletionRequest(BaseModel):
 # 工具函数
 
 
+# 消息角色对应的 prompt 前缀，未列出的角色会被忽略
+ROLE_PREFIX = {
+    "system": "System: ",
+    "user": "Human: ",
+    "assistant": "Assistant: ",
+}
+
+
 def convert_messages_to_ollama_prompt(messages: List[Message]) -> str:
     """将 OpenAI 格式的消息转换为 Ollama prompt"""
-    prompt = ""
+    # 先收集片段再一次性拼接，避免循环中反复创建新字符串
+    parts = []
+    append = parts.append
+    get_prefix = ROLE_PREFIX.get
 
     for message in messages:
-        if message.role == "system":
-            prompt += f"System: {message.content}\n\n"
-        elif message.role == "user":
-            prompt += f"Human: {message.content}\n\n"
-        elif message.role == "assistant":
-            prompt += f"Assistant: {message.content}\n\n"
+        prefix = get_prefix(message.role)
+        if prefix is None:
+            continue
+        append(prefix)
+        append(message.content)
+        append("\n\n")
 
-    # 确保以 Assistant: 结尾以触发响应
-    if not prompt.endswith("Assistant:"):
-        prompt += "Assistant:"
+    # 确保以 Assistant: 结尾以触发响应（每条消息都以空行结尾，因此总是需要追加）
+    append("Assistant:")
 
-    return prompt
+    return "".join(parts)
 
 
 def create_chat_completion_response(content: str, model: str, finish_reason: str = "stop",
                                     usage: Optional[Dict] = None) -> Dict:
     """创建 OpenAI 格式的聊天响应"""
     return {
-        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "id": f"chatcmpl-{secrets.token_hex(4)}",
         "object": "chat.completion",
         "created": int(time.time()),
         "model": model,
@@ -110,20 +286,388 @@ def create_chat_completion_response(content: str, model: str, finish_reason: str
     }
 
 
-def create_stream_chunk(content: str, model: str, finish_reason: Optional[str] = None) -> str:
-    """创建 OpenAI 格式的流式响应块"""
-    chunk = {
-        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": model,
-        "choices": [{
-            "index": 0,
-            "delta": {"content": content} if content else {},
-            "finish_reason": finish_reason
-        }]
+def extract_usage(ollama_response: Dict) -> Dict:
+    """从 Ollama 响应中提取 OpenAI 格式的 token 用量"""
+    prompt_tokens = ollama_response.get("prompt_eval_count", 0)
+    completion_tokens = ollama_response.get("eval_count", 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
     }
-    return f"data: {json.dumps(chunk)}\n\n"
+
+
+def make_cache_key(kind: str, model: str, prompt: str, temperature: Optional[float],
+                   max_tokens: Optional[int], top_p: Optional[float] = None) -> Optional[Tuple]:
+    """生成响应缓存键，非确定性请求（temperature 不为 0）返回 None"""
+    if temperature != 0:
+        return None
+    return (kind, model, prompt, max_tokens, top_p)
+
+
+def cache_get(key: Optional[Tuple]) -> Optional[Tuple[str, Dict]]:
+    """读取缓存的 (content, usage)，命中时刷新 LRU 顺序"""
+    if key is None:
+        return None
+    entry = response_cache.get(key)
+    if entry is not None:
+        response_cache.move_to_end(key)
+    return entry
+
+
+def cache_put(key: Optional[Tuple], content: str, usage: Dict):
+    """写入缓存，超出容量时淘汰最久未使用的条目"""
+    if key is None:
+        return
+    response_cache[key] = (content, usage)
+    response_cache.move_to_end(key)
+    if len(response_cache) > CACHE_MAX:
+        response_cache.popitem(last=False)
+
+
+def split_cached_content(content: str) -> List[str]:
+    """将缓存的完整文本按词切分，用于模拟流式回放（拼接后与原文一致）"""
+    words = content.split(" ")
+    return [words[0]] + [" " + word for word in words[1:]]
+
+
+def record_timing(stage: str, elapsed_ns: int, pieces: int = 0):
+    """记录一个阶段的耗时（仅在 METRICS=1 时调用）"""
+    logger.info(f"[metrics] {stage}: {elapsed_ns / 1e6:.2f}ms" + (f", pieces={pieces}" if pieces else ""))
+    if ollama_latency is not None:
+        ollama_latency.labels(stage).observe(elapsed_ns / 1e9)
+        if pieces:
+            ollama_pieces.inc(pieces)
+
+
+def json_response(content: Union[Dict, bytes]) -> Response:
+    """
+    直接返回 JSON 字节响应，绕过 FastAPI 的 jsonable_encoder 和二次序列化
+    传入 dict 时用 orjson 序列化一次，传入已序列化的 bytes 时原样发送
+    """
+    if isinstance(content, bytes):
+        body = content
+    elif METRICS_ENABLED:
+        started = time.perf_counter_ns()
+        body = orjson.dumps(content)
+        record_timing("json_encode", time.perf_counter_ns() - started)
+    else:
+        body = orjson.dumps(content)
+    return Response(content=body, media_type="application/json")
+
+
+def create_stream_chunk_prefix(chat_id: str, created: int, model: str) -> bytes:
+    """预先序列化流式响应块的公共前缀（同一响应内 id、created、model 均不变）"""
+    return (b'data: {"id":' + orjson.dumps(chat_id) +
+            b',"object":"chat.completion.chunk","created":' + str(created).encode() +
+            b',"model":' + orjson.dumps(model) +
+            b',"choices":[{"index":0,"delta":')
+
+
+def create_stream_chunk(prefix: bytes, content: str, finish_reason: Optional[str] = None) -> bytes:
+    """创建 OpenAI 格式的流式响应块，只序列化随 token 变化的字段"""
+    delta = b'{"content":' + orjson.dumps(content) + b'}' if content else b'{}'
+    finish = b'null' if finish_reason is None else orjson.dumps(finish_reason)
+    return prefix + delta + b',"finish_reason":' + finish + b'}]}\n\n'
+
+
+def create_stream_chunk_from_json(prefix: bytes, content_json: bytes) -> bytes:
+    """直接拼接已是 JSON 编码的 content 字符串，省去解码再编码"""
+    return prefix + b'{"content":' + content_json + b'},"finish_reason":null}]}\n\n'
+
+
+def create_completion_chunk_prefix(completion_id: str, created: int, model: str) -> bytes:
+    """预先序列化文本完成流式响应块的公共前缀"""
+    return (b'data: {"id":' + orjson.dumps(completion_id) +
+            b',"object":"text_completion","created":' + str(created).encode() +
+            b',"model":' + orjson.dumps(model) +
+            b',"choices":[{"text":')
+
+
+def create_completion_stream_chunk(prefix: bytes, text_json: bytes,
+                                   finish_reason: Optional[str] = None) -> bytes:
+    """创建 OpenAI 格式的文本完成流式响应块，text_json 为已 JSON 编码的字符串"""
+    finish = b'null' if finish_reason is None else orjson.dumps(finish_reason)
+    return prefix + text_json + b',"index":0,"finish_reason":' + finish + b'}]}\n\n'
+
+
+def parse_ollama_line(line: bytes) -> Tuple[Optional[bytes], bool]:
+    """解析一行 Ollama NDJSON，返回 (JSON 编码的 response 片段，为空时为 None；是否结束)"""
+    # 快速路径：直接截取 Ollama 已编码好的 response 字符串
+    extracted = extract_ollama_response(line)
+    if extracted is not None:
+        content, done = extracted
+        return (content if content != b'""' else None), done
+
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None, False
+    content = orjson.dumps(data["response"]) if data.get("response") else None
+    return content, bool(data.get("done"))
+
+
+def extract_ollama_response(line: bytes) -> Optional[Tuple[bytes, bool]]:
+    """
+    从 Ollama 的 NDJSON 行中直接截取 response 字段（保留 JSON 编码）和 done 标志
+    格式不符合预期时返回 None，由调用方回退到完整解析
+    """
+    start = line.find(b'"response":"')
+    if start == -1:
+        return None
+    start += len(b'"response":')
+
+    # 查找字符串结束的引号，跳过被反斜杠转义的引号
+    end = start
+    while True:
+        end = line.find(b'"', end + 1)
+        if end == -1:
+            return None
+        backslashes = 0
+        while line[end - 1 - backslashes] == 0x5C:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            break
+
+    return line[start:end + 1], b'"done":true' in line
+
+# Ollama 请求
+
+
+async def fetch_generation(payload: Dict, cache_key: Optional[Tuple] = None) -> Tuple[str, Dict]:
+    """向 Ollama 发起非流式生成请求，返回 (content, usage) 并写入缓存"""
+    async with ollama_slot():
+        started = time.perf_counter_ns()
+        async with session.post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json=payload
+        ) as response:
+            if response.status != 200:
+                raise HTTPException(status_code=response.status,
+                                    detail="Failed to generate response")
+
+            body = await response.read()
+
+    if METRICS_ENABLED:
+        received = time.perf_counter_ns()
+        ollama_response = orjson.loads(body)
+        record_timing("ollama_rtt", received - started)
+        record_timing("json_decode", time.perf_counter_ns() - received)
+    else:
+        ollama_response = orjson.loads(body)
+
+    content = ollama_response.get("response", "")
+    usage = extract_usage(ollama_response)
+    cache_put(cache_key, content, usage)
+    return content, usage
+
+
+async def generate_deduplicated(cache_key: Optional[Tuple], payload: Dict) -> Tuple[str, Dict]:
+    """非流式生成；相同的确定性请求正在进行时直接等待其结果，不重复调用 Ollama"""
+    if cache_key is None:
+        return await fetch_generation(payload)
+
+    task = inflight.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(fetch_generation(payload, cache_key))
+        inflight[cache_key] = task
+        task.add_done_callback(lambda _: inflight.pop(cache_key, None))
+
+    # shield：某个调用方断开连接时不取消其他调用方共享的生成任务
+    return await asyncio.shield(task)
+
+
+async def iter_ollama_stream(payload: Dict, slot: OllamaSlot,
+                             final: Optional[Dict] = None) -> AsyncIterator[bytes]:
+    """
+    向 Ollama 发起流式生成请求，逐个产出 response 片段（保留 JSON 编码的字符串）
+    slot 为调用方事先占用的槽位，流结束时释放；传入 final 时写入最后一行（含 token 用量）的解析结果
+    Ollama 返回错误或流意外中断时抛出 RuntimeError
+    """
+    try:
+        async with session.post(
+            f"{OLLAMA_BASE_URL}/api/generate",
+            json=payload
+        ) as stream_response:
+            if stream_response.status != 200:
+                error_msg = await stream_response.read()
+                raise RuntimeError(error_msg.decode())
+
+            started = time.perf_counter_ns()
+            pieces = 0
+            try:
+                # 直接在原始字节上按换行切分 NDJSON，不做逐行的文本解码
+                buffer = bytearray()
+                async for chunk in stream_response.content.iter_any():
+                    buffer.extend(chunk)
+                    start = 0
+                    while (newline := buffer.find(b"\n", start)) != -1:
+                        line = bytes(buffer[start:newline])
+                        content, done = parse_ollama_line(line)
+                        start = newline + 1
+                        if content is not None:
+                            pieces += 1
+                            yield content
+                        if done:
+                            if final is not None:
+                                final.update(orjson.loads(line))
+                            return
+                    del buffer[:start]
+            finally:
+                if METRICS_ENABLED:
+                    record_timing("ollama_stream", time.perf_counter_ns() - started, pieces)
+    finally:
+        slot.release()
+
+    raise RuntimeError("Ollama stream ended unexpectedly")
+
+
+class StreamFanout:
+    """
+    将一次 Ollama 流式生成广播给多个订阅者，后加入的订阅者会先回放已生成的片段
+    所有订阅者都断开后取消生成并释放槽位；正常结束时把完整结果写入缓存
+    """
+
+    def __init__(self, cache_key: Tuple, payload: Dict, slot: OllamaSlot):
+        self.cache_key = cache_key
+        self.pieces: List[bytes] = []
+        self.finished = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(payload, slot))
+        inflight_streams[cache_key] = self
+        self.task.add_done_callback(lambda _: self._unregister())
+
+    async def _run(self, payload: Dict, slot: OllamaSlot):
+        final: Dict = {}
+        try:
+            async for piece in iter_ollama_stream(payload, slot, final):
+                self.pieces.append(piece)
+                self._notify()
+            # 片段都是 JSON 字符串字面量，去掉各自的引号后拼成一个字面量再解码
+            content = orjson.loads(b'"' + b"".join(piece[1:-1] for piece in self.pieces) + b'"')
+            cache_put(self.cache_key, content, extract_usage(final))
+        except Exception as stream_error:
+            self.error = stream_error
+        finally:
+            slot.release()
+            self.finished = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _unregister(self):
+        # 被取消的广播提前移除，之后相同请求进来的新广播不能被它的回调误删
+        if inflight_streams.get(self.cache_key) is self:
+            del inflight_streams[self.cache_key]
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        # 在订阅时立即计数，避免响应体开始前最后一个订阅者断开导致广播被取消
+        self.subscribers += 1
+        return self._replay()
+
+    async def _replay(self) -> AsyncIterator[bytes]:
+        try:
+            index = 0
+            while True:
+                while index < len(self.pieces):
+                    yield self.pieces[index]
+                    index += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.finished:
+                self._unregister()
+                self.task.cancel()
+
+
+async def coalesce_pieces(pieces: AsyncGenerator[bytes, None]) -> AsyncIterator[bytes]:
+    """
+    合并短时间内连续到达的 response 片段，减少 SSE 事件和写入次数
+    片段均为 JSON 字符串字面量，去掉相邻的引号即可直接拼接，客户端拼出的文本不变
+    有未发出的片段时最多等待 STREAM_FLUSH_INTERVAL 秒，下一个片段迟迟不来也会按时发出
+    """
+    loop = asyncio.get_running_loop()
+    pending: Optional[bytes] = None
+    last_flush = loop.time()
+    # 计时器到期时尚未完成的 __anext__，留到下一轮继续等待而不是取消
+    next_piece: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None and next_piece is None:
+                # 没有待发送的内容，不需要计时，直接等待下一个片段
+                try:
+                    piece = await pieces.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if next_piece is None:
+                    next_piece = asyncio.ensure_future(pieces.__anext__())
+                if pending is not None:
+                    remaining = last_flush + STREAM_FLUSH_INTERVAL - loop.time()
+                    done, _ = await asyncio.wait((next_piece,), timeout=max(remaining, 0))
+                    if not done:
+                        yield pending
+                        pending = None
+                        last_flush = loop.time()
+                        continue
+                arrived, next_piece = next_piece, None
+                try:
+                    piece = await arrived
+                except StopAsyncIteration:
+                    break
+
+            pending = piece if pending is None else pending[:-1] + piece[1:]
+            now = loop.time()
+            if len(pending) > STREAM_FLUSH_BYTES or now - last_flush > STREAM_FLUSH_INTERVAL:
+                yield pending
+                pending = None
+                last_flush = now
+    except Exception:
+        # 出错前已收到的片段仍然先发给客户端
+        if pending is not None:
+            yield pending
+        raise
+    finally:
+        if next_piece is not None:
+            next_piece.cancel()
+            try:
+                await next_piece
+            except (asyncio.CancelledError, Exception):
+                pass
+        await pieces.aclose()
+    if pending is not None:
+        yield pending
+
+
+async def open_stream(cache_key: Optional[Tuple], payload: Dict) -> Tuple[AsyncIterator[bytes], Optional[OllamaSlot]]:
+    """
+    开始流式生成；相同的确定性请求正在进行时订阅同一个 Ollama 流
+    需要新的 Ollama 流时在返回响应头之前占用槽位，排队超时以 503 返回
+    返回 (片段迭代器, 由响应负责释放的槽位)；订阅广播时槽位归广播任务所有，返回 None
+    """
+    fanout = inflight_streams.get(cache_key) if cache_key is not None else None
+    if fanout is not None:
+        return fanout.subscribe(), None
+
+    slot = await acquire_ollama_slot()
+    if cache_key is None:
+        return iter_ollama_stream(payload, slot), slot
+
+    fanout = inflight_streams.get(cache_key)
+    if fanout is not None:
+        # 等待槽位期间相同的请求已经开始生成
+        slot.release()
+    else:
+        fanout = StreamFanout(cache_key, payload, slot)
+    return fanout.subscribe(), None
 
 # API 端点
 
@@ -132,30 +676,34 @@ def create_stream_chunk(content: str, model: str, finish_reason: Optional[str] =
 @app.get("/models")  # 兼容不带 v1 的路径
 async def list_models():
     """列出可用模型 - OpenAI 格式"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=10.0)
+    now = time.monotonic()
+    if _models_cache["data"] is not None and now - _models_cache["ts"] < MODELS_CACHE_TTL:
+        return json_response(_models_cache["data"])
 
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code,
-                                    detail="Failed to fetch models from Ollama")
-
-            ollama_models = response.json().get("models", [])
-
-            # 转换为 OpenAI 格式
-            openai_models = []
-            for model in ollama_models:
-                openai_models.append({
-                    "id": model["name"],
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "ollama"
-                })
-
-            return {
-                "object": "list",
-                "data": openai_models
-            }
+    try:
+        response = await client.get("/api/tags", timeout=10.0)
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code,
+                                detail="Failed to fetch models from Ollama")
+
+        ollama_models = orjson.loads(response.content).get("models", [])
+
+        # 转换为 OpenAI 格式
+        created = int(time.time())
+        openai_models = [{
+            "id": model["name"],
+            "object": "model",
+            "created": created,
+            "owned_by": "ollama"
+        } for model in ollama_models]
+
+        _models_cache["data"] = orjson.dumps({
+            "object": "list",
+            "data": openai_models
+        })
+        _models_cache["ts"] = now
+        return json_response(_models_cache["data"])
 
     except httpx.RequestError as request_error:
         logger.error(f"Failed to connect to Ollama: {request_error}")
@@ -183,50 +731,41 @@ async def chat_completions(request: ChatCompletionRequest):
             }
         }
 
+        cache_key = make_cache_key("chat", request.model, prompt, request.temperature,
+                                   request.max_tokens, request.top_p)
+        cached = cache_get(cache_key)
+
         if request.stream:
             # 流式响应
+            async def replay_stream(content: str):
+                prefix = create_stream_chunk_prefix(
+                    f"chatcmpl-{secrets.token_hex(4)}", int(time.time()), request.model)
+                for piece in split_cached_content(content):
+                    if piece:
+                        yield create_stream_chunk(prefix, piece)
+                yield create_stream_chunk(prefix, "", "stop")
+                yield DONE_BYTES
+
+            slot = None
+            if cached is None:
+                pieces, slot = await open_stream(cache_key, ollama_payload)
+
             async def generate_stream():
-                async with httpx.AsyncClient(timeout=TIMEOUT) as stream_client:
-                    try:
-                        async with stream_client.stream(
-                            "POST",
-                            f"{OLLAMA_BASE_URL}/api/generate",
-                            json=ollama_payload
-                        ) as stream_response:
-                            if stream_response.status_code != 200:
-                                error_msg = await stream_response.aread()
-                                yield create_stream_chunk(
-                                    f"Error: {error_msg.decode()}",
-                                    request.model,
-                                    "error"
-                                )
-                                return
-
-                            async for line in stream_response.aiter_lines():
-                                if line:
-                                    try:
-                                        data = json.loads(line)
-                                        if data.get("response"):
-                                            yield create_stream_chunk(
-                                                data["response"],
-                                                request.model
-                                            )
-                                        if data.get("done"):
-                                            yield create_stream_chunk(
-                                                "",
-                                                request.model,
-                                                "stop"
-                                            )
-                                            yield "data: [DONE]\n\n"
-                                            return
-                                    except json.JSONDecodeError:
-                                        continue
-                    except Exception as stream_error:
-                        logger.error(f"Stream error: {stream_error}")
-                        yield create_stream_chunk(f"Error: {str(stream_error)}", request.model, "error")
-
-            return StreamingResponse(
-                generate_stream(),
+                chat_id = f"chatcmpl-{secrets.token_hex(4)}"
+                created = int(time.time())
+                prefix = create_stream_chunk_prefix(chat_id, created, request.model)
+                try:
+                    async for content in coalesce_pieces(pieces):
+                        yield create_stream_chunk_from_json(prefix, content)
+                    yield create_stream_chunk(prefix, "", "stop")
+                    yield DONE_BYTES
+                except Exception as stream_error:
+                    logger.error(f"Stream error: {stream_error}")
+                    yield create_stream_chunk(prefix, f"Error: {str(stream_error)}", "error")
+
+            return OllamaStreamingResponse(
+                generate_stream() if cached is None else replay_stream(cached[0]),
+                slot=slot,
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
@@ -236,32 +775,20 @@ async def chat_completions(request: ChatCompletionRequest):
             )
         else:
             # 非流式响应
-            async with httpx.AsyncClient(timeout=TIMEOUT) as non_stream_client:
-                non_stream_response = await non_stream_client.post(
-                    f"{OLLAMA_BASE_URL}/api/generate",
-                    json=ollama_payload
-                )
-
-                if non_stream_response.status_code != 200:
-                    raise HTTPException(status_code=non_stream_response.status_code,
-                                        detail="Failed to generate response")
-
-                ollama_response = non_stream_response.json()
-
-                # 转换为 OpenAI 格式
-                usage = {
-                    "prompt_tokens": ollama_response.get("prompt_eval_count", 0),
-                    "completion_tokens": ollama_response.get("eval_count", 0),
-                    "total_tokens": (ollama_response.get("prompt_eval_count", 0) +
-                                     ollama_response.get("eval_count", 0))
-                }
-
-                return create_chat_completion_response(
-                    content=ollama_response.get("response", ""),
-                    model=request.model,
-                    usage=usage
-                )
+            if cached is not None:
+                content, usage = cached
+            else:
+                content, usage = await generate_deduplicated(cache_key, ollama_payload)
 
+            # 转换为 OpenAI 格式
+            return json_response(create_chat_completion_response(
+                content=content,
+                model=request.model,
+                usage=usage
+            ))
+
+    except HTTPException:
+        raise
     except Exception as chat_error:
         logger.error(f"Chat completion error: {chat_error}")
         raise HTTPException(status_code=500, detail=str(chat_error))
@@ -282,74 +809,64 @@ async def completions(request: CompletionRequest):
             }
         }
 
+        cache_key = make_cache_key("completion", request.model, request.prompt,
+                                   request.temperature, request.max_tokens)
+        cached = cache_get(cache_key)
+
         if request.stream:
             # 流式响应
+            async def replay_stream(content: str):
+                prefix = create_completion_chunk_prefix(
+                    f"cmpl-{secrets.token_hex(4)}", int(time.time()), request.model)
+                for piece in split_cached_content(content):
+                    if piece:
+                        yield create_completion_stream_chunk(prefix, orjson.dumps(piece))
+                yield DONE_BYTES
+
+            slot = None
+            if cached is None:
+                pieces, slot = await open_stream(cache_key, ollama_payload)
+
             async def generate_stream():
-                async with httpx.AsyncClient(timeout=TIMEOUT) as completion_stream_client:
-                    async with completion_stream_client.stream(
-                        "POST",
-                        f"{OLLAMA_BASE_URL}/api/generate",
-                        json=ollama_payload
-                    ) as completion_stream_response:
-                        async for line in completion_stream_response.aiter_lines():
-                            if line:
-                                try:
-                                    data = json.loads(line)
-                                    if data.get("response"):
-                                        chunk = {
-                                            "id": f"cmpl-{uuid.uuid4().hex[:8]}",
-                                            "object": "text_completion",
-                                            "created": int(time.time()),
-                                            "model": request.model,
-                                            "choices": [{
-                                                "text": data["response"],
-                                                "index": 0,
-                                                "finish_reason": None
-                                            }]
-                                        }
-                                        yield f"data: {json.dumps(chunk)}\n\n"
-                                    if data.get("done"):
-                                        yield "data: [DONE]\n\n"
-                                        return
-                                except json.JSONDecodeError:
-                                    continue
-
-            return StreamingResponse(
-                generate_stream(),
+                completion_id = f"cmpl-{secrets.token_hex(4)}"
+                created = int(time.time())
+                prefix = create_completion_chunk_prefix(completion_id, created, request.model)
+                try:
+                    async for text in coalesce_pieces(pieces):
+                        yield create_completion_stream_chunk(prefix, text)
+                    yield DONE_BYTES
+                except Exception as stream_error:
+                    logger.error(f"Stream error: {stream_error}")
+                    yield create_completion_stream_chunk(
+                        prefix, orjson.dumps(f"Error: {str(stream_error)}"), "error")
+
+            return OllamaStreamingResponse(
+                generate_stream() if cached is None else replay_stream(cached[0]),
+                slot=slot,
                 media_type="text/event-stream"
             )
         else:
             # 非流式响应
-            async with httpx.AsyncClient(timeout=TIMEOUT) as completion_client:
-                completion_response = await completion_client.post(
-                    f"{OLLAMA_BASE_URL}/api/generate",
-                    json=ollama_payload
-                )
-
-                if completion_response.status_code != 200:
-                    raise HTTPException(status_code=completion_response.status_code,
-                                        detail="Failed to generate response")
-
-                ollama_response = completion_response.json()
-
-                return {
-                    "id": f"cmpl-{uuid.uuid4().hex[:8]}",
-                    "object": "text_completion",
-                    "created": int(time.time()),
-                    "model": request.model,
-                    "choices": [{
-                        "text": ollama_response.get("response", ""),
-                        "index": 0,
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": ollama_response.get("prompt_eval_count", 0),
-                        "completion_tokens": ollama_response.get("eval_count", 0),
-                        "total_tokens": (ollama_response.get("prompt_eval_count", 0) +
-                                         ollama_response.get("eval_count", 0))
-                    }
-                }
-
+            if cached is not None:
+                text, usage = cached
+            else:
+                text, usage = await generate_deduplicated(cache_key, ollama_payload)
+
+            return json_response({
+                "id": f"cmpl-{secrets.token_hex(4)}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": request.model,
+                "choices": [{
+                    "text": text,
+                    "index": 0,
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+    except HTTPException:
+        raise
     except Exception as completion_error:
         logger.error(f"Completion error: {completion_error}")
         raise HTTPException(status_code=500, detail=str(completion_error))
@@ -359,21 +876,21 @@ async def completions(request: CompletionRequest):
 @app.get("/health")
 async def health_check():
     """健康检查"""
+    now = time.monotonic()
+    if now - _health_cache["ts"] < HEALTH_CACHE_TTL:
+        return json_response(HEALTHY_BYTES)
+
     try:
-        async with httpx.AsyncClient() as health_client:
-            health_response = await health_client.get(f"{OLLAMA_BASE_URL}/api/version", timeout=5.0)
-            if health_response.status_code == 200:
-                return {
-                    "status": "healthy",
-                    "ollama": "connected",
-                    "api": "openai-compatible"
-                }
+        health_response = await client.get("/api/version", timeout=5.0)
+        if health_response.status_code == 200:
+            _health_cache["ts"] = now
+            return json_response(HEALTHY_BYTES)
     except Exception as health_error:
-        return {
+        return json_response({
             "status": "unhealthy",
             "ollama": "disconnected",
             "error": str(health_error)
-        }
+        })
 
 
 if __name__ == "__main__":
@@ -384,4 +901,18 @@ if __name__ == "__main__":
     logger.info("  - /v1/models or /models")
     logger.info("  - /v1/chat/completions or /chat/completions")
     logger.info("  - /v1/completions or /completions")
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
+    # 每个 worker 进程在启动时各自创建连接池、缓存和并发信号量
+    workers = int(os.getenv("WORKERS", str(max(2, (os.cpu_count() or 2) // 2))))
+    logger.info(f"Workers: {workers}")
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=8000,
+        # uvloop 不支持 Windows，此时使用 asyncio 默认事件循环
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=workers,
+        log_level="info",
+        reload=False
+    )